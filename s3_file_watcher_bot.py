@@ -1,9 +1,14 @@
 import os
-import json
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from urllib.parse import quote, unquote_plus, urlparse
 
 import discord
 import boto3
+import orjson
+from botocore.config import Config
 from discord.ext import tasks, commands
 from dotenv import load_dotenv
 
@@ -20,42 +25,127 @@ S3_ENDPOINT = os.getenv("S3_ENDPOINT")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 BUCKET_ID = os.getenv("BUCKET_ID")  # NEW: used in download URL
 
-# JSON files to persist data
+# Optional: SQS queue receiving the bucket's event notifications. When set,
+# the bot consumes events instead of polling the bucket.
+SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
+# Region of the queue; falls back to AWS_DEFAULT_REGION, then to the region in
+# an AWS queue URL
+SQS_REGION = os.getenv("SQS_REGION") or os.getenv("AWS_DEFAULT_REGION")
+
+# Public Contabo download URLs are this prefix followed by the object key
+DOWNLOAD_URL_PREFIX = f"{S3_ENDPOINT}/{BUCKET_ID}:{S3_BUCKET_NAME}/"
+
+# JSON file to persist data
+STATE_PATH = "state.json"
+
+# Separate files written by older versions, migrated into STATE_PATH
 SENT_FILES_PATH = "sent_files.json"
 FILE_MESSAGES_PATH = "file_messages.json"
 
+# Every Nth poll lists the whole bucket to reconcile deletions; the polls in
+# between only list keys after the last one seen. The default of 1 lists the
+# whole bucket on every poll, because keys that sort before the last one seen
+# and deletions are only picked up by full scans.
+FULL_SCAN_INTERVAL = max(1, int(os.getenv("FULL_SCAN_INTERVAL", "1")))
+
+# Maximum number of Discord API calls in flight at once (Discord allows about
+# 5 message operations per second per channel)
+DISCORD_CONCURRENCY = 5
+
+# Seconds to wait after a failed SQS poll before trying again. The event loop
+# task has no interval of its own, so without this a persistent error (bad
+# queue URL, missing permissions, network outage) would retry in a tight loop.
+SQS_RETRY_DELAY = 10
+
 
 def load_sent_files():
-    """Load the list of already-sent files from disk."""
+    """Load the list of already-sent files from the legacy state file."""
     if os.path.exists(SENT_FILES_PATH):
-        with open(SENT_FILES_PATH, "r") as f:
-            return set(json.load(f))
+        with open(SENT_FILES_PATH, "rb") as f:
+            return set(orjson.loads(f.read()))
     return set()
 
 
-def save_sent_files(files):
-    """Save the list of sent files to disk."""
-    with open(SENT_FILES_PATH, "w") as f:
-        json.dump(list(files), f)
-
-
 def load_file_messages():
-    """Load the mapping of files to Discord message IDs."""
+    """Load the mapping of files to Discord message IDs from the legacy state file."""
     if os.path.exists(FILE_MESSAGES_PATH):
-        with open(FILE_MESSAGES_PATH, "r") as f:
-            return json.load(f)
+        with open(FILE_MESSAGES_PATH, "rb") as f:
+            return orjson.loads(f.read())
     return {}
 
 
-def save_file_messages(file_messages):
-    """Save the mapping of files to Discord message IDs."""
-    with open(FILE_MESSAGES_PATH, "w") as f:
-        json.dump(file_messages, f)
-
-
-# Track files that have already triggered notifications
-sent_files = load_sent_files()
-file_messages = load_file_messages()
+def load_state():
+    """Load the sent files, their Discord message IDs and event sequencers."""
+    if os.path.exists(STATE_PATH):
+        with open(STATE_PATH, "rb") as f:
+            state = orjson.loads(f.read())
+        return set(state["sent"]), state["msgs"], state.get("seqs", {})
+    return load_sent_files(), load_file_messages(), {}
+
+
+def save_state(sent_files, file_messages, event_sequencers):
+    """Atomically save the sent files, message IDs and event sequencers to disk."""
+    tmp_path = STATE_PATH + ".tmp"
+    state = {
+        "sent": list(sent_files),
+        "msgs": file_messages,
+        "seqs": event_sequencers,
+    }
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, STATE_PATH)
+
+
+def get_sqs_client_options(queue_url):
+    """Work out the SQS client's region and endpoint from the queue URL."""
+    parsed = urlparse(queue_url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(
+            f"SQS_QUEUE_URL must be a full http(s) queue URL, got {queue_url!r}"
+        )
+
+    labels = parsed.hostname.split(".")
+    if "amazonaws" in labels:
+        # https://sqs.<region>.amazonaws.com/<account>/<queue>, or the legacy
+        # https://<region>.queue.amazonaws.com/<account>/<queue>
+        region = SQS_REGION or (labels[1] if labels[0] == "sqs" else labels[0])
+        return {"region_name": region}
+
+    # SQS-compatible services (e.g. LocalStack) are reached at the queue's host
+    if not SQS_REGION:
+        raise ValueError(
+            "SQS_REGION must be set when SQS_QUEUE_URL is not an AWS queue URL"
+        )
+    return {
+        "region_name": SQS_REGION,
+        "endpoint_url": f"{parsed.scheme}://{parsed.netloc}",
+    }
+
+
+# Track files that have already triggered notifications. This must stay an
+# exact set: full scans enumerate it to find deleted files, and a false
+# positive from a probabilistic filter would silently drop a notification.
+# event_sequencers maps each key to the sequencer (hex string) of the last
+# bucket event applied for it in SQS mode, used to drop stale events.
+sent_files, file_messages, event_sequencers = load_state()
+
+# S3 lists keys in lexicographic order, so anything newer than the highest
+# key seen so far can be fetched with StartAfter
+last_key = max(sent_files, default="")
+
+# Set when in-memory state has changes not yet written to disk
+state_dirty = False
+
+# Connection pooling and retry settings shared by the AWS clients. The clients
+# live for the whole process so pooled keep-alive connections are reused
+# across polls instead of re-handshaking TLS each time.
+aws_config = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive", "max_attempts": 3},
+)
 
 # Initialize S3 client
 s3 = boto3.client(
@@ -63,31 +153,63 @@ s3 = boto3.client(
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
     endpoint_url=S3_ENDPOINT,
+    config=aws_config,
+)
+
+# Dedicated worker threads for blocking AWS calls and state-file writes, so
+# neither competes with the other (or with discord.py) for the default pool
+aws_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="aws")
+io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="io")
+
+# Initialize SQS client when event notifications are used
+sqs = (
+    boto3.client(
+        "sqs",
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        config=aws_config,
+        **get_sqs_client_options(SQS_QUEUE_URL),
+    )
+    if SQS_QUEUE_URL
+    else None
 )
 
 # Set up Discord bot
 intents = discord.Intents.default()
 bot = commands.Bot(command_prefix="!", intents=intents)
+discord_semaphore = asyncio.Semaphore(DISCORD_CONCURRENCY)
+
+
+# Fields every list_objects_v2 entry already carries. Notifications are built
+# from these alone; do not add a per-object head_object call, which would turn
+# one listing request into one request per file.
+METADATA_KEYS = ("Key", "Size", "LastModified")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
 def get_file_metadata(obj):
     """Extract file size (MB) and creation timestamp from S3 object metadata."""
+    assert all(k in obj for k in METADATA_KEYS)
     size_mb = round(obj["Size"] / (1024 * 1024), 2)
-    created_time = obj["LastModified"].replace(tzinfo=timezone.utc).timestamp()
-    return size_mb, int(created_time)
+    # botocore already returns LastModified as an aware datetime
+    created_time = int((obj["LastModified"] - EPOCH).total_seconds())
+    return size_mb, created_time
 
 
 def build_download_url(filename):
     """Construct the public Contabo download URL using BUCKET_ID."""
-    return f"{S3_ENDPOINT}/{BUCKET_ID}:{S3_BUCKET_NAME}/{filename}"
+    return DOWNLOAD_URL_PREFIX + quote(filename, safe="/")
 
 
-async def send_file_embed(channel, filename, size_mb, timestamp, download_url):
+async def send_file_embed(
+    channel, filename, size_mb, timestamp, download_url, sent_at
+):
     """Send a rich embed to the Discord channel."""
     embed = discord.Embed(
         title=f"🆕 New File Uploaded: `{filename}`",
         color=0x00FF99,
-        timestamp=datetime.utcnow(),
+        timestamp=sent_at,
     )
     embed.add_field(name="File Size", value=f"{size_mb} MB", inline=True)
     embed.add_field(name="Created At", value=f"<t:{timestamp}:F>", inline=True)
@@ -99,65 +221,284 @@ async def send_file_embed(channel, filename, size_mb, timestamp, download_url):
     return message.id
 
 
+async def announce_new_files(channel, new_files):
+    """Send an embed for each new file and remember its message ID.
+
+    Returns the set of filenames whose embed could not be sent.
+    """
+    sent_at = datetime.now(timezone.utc)
+    failed_files = set()
+
+    async def notify(obj):
+        filename = obj["Key"]
+        try:
+            size_mb, timestamp = get_file_metadata(obj)
+            download_url = build_download_url(filename)
+            async with discord_semaphore:
+                message_id = await send_file_embed(
+                    channel,
+                    filename,
+                    size_mb,
+                    timestamp,
+                    download_url,
+                    sent_at,
+                )
+        except Exception as e:
+            print(f"[ERROR] Failed to send embed for {filename}: {e}")
+            # Forget the file so it is announced again on the next attempt
+            sent_files.discard(filename)
+            failed_files.add(filename)
+            return
+        file_messages[filename] = message_id
+
+    await asyncio.gather(*(notify(obj) for obj in new_files))
+    return failed_files
+
+
+async def remove_deleted_files(channel, deleted_files):
+    """Delete the embeds of removed files and forget them."""
+
+    async def unannounce(filename, message_id):
+        async with discord_semaphore:
+            try:
+                message = await channel.fetch_message(message_id)
+                await message.delete()
+            except discord.NotFound:
+                pass  # Message already deleted
+            except Exception as e:
+                print(f"[ERROR] Failed to delete message for {filename}: {e}")
+
+    await asyncio.gather(
+        *(
+            unannounce(filename, file_messages[filename])
+            for filename in deleted_files
+            if filename in file_messages
+        )
+    )
+
+    for filename in deleted_files:
+        file_messages.pop(filename, None)
+        sent_files.discard(filename)
+
+
+async def flush_state():
+    """Write pending state changes to disk without blocking the event loop."""
+    global state_dirty
+    # The flag outlives a failed tick, so the next one retries the write
+    if state_dirty:
+        await asyncio.get_running_loop().run_in_executor(
+            io_executor, save_state, sent_files, file_messages, event_sequencers
+        )
+        state_dirty = False
+
+
 @tasks.loop(seconds=8)  # Check every 8 seconds
 async def monitor_bucket():
-    global sent_files, file_messages
+    global last_key, state_dirty
+    try:
+        full_scan = monitor_bucket.current_loop % FULL_SCAN_INTERVAL == 0
+        list_kwargs = {"Bucket": S3_BUCKET_NAME}
+        if not full_scan and last_key:
+            list_kwargs["StartAfter"] = last_key
+
+        paginator = s3.get_paginator("list_objects_v2")
+        pages = iter(
+            paginator.paginate(**list_kwargs, PaginationConfig={"PageSize": 1000})
+        )
+
+        current_files = set()
+        new_files = []
+        listed_last_key = last_key
+        # Fetch pages one at a time in a worker thread so the event loop keeps
+        # serving Discord heartbeats during each S3 round-trip
+        loop = asyncio.get_running_loop()
+        while (
+            page := await loop.run_in_executor(aws_executor, next, pages, None)
+        ) is not None:
+            contents = page.get("Contents", [])
+
+            # Record every listed key and check for new files in one pass
+            for obj in contents:
+                key = obj["Key"]
+                current_files.add(key)
+                if key not in sent_files:
+                    new_files.append(obj)
+
+            if contents:
+                listed_last_key = max(listed_last_key, contents[-1]["Key"])
+
+        # Only mark files as seen once the whole listing has succeeded, so a
+        # failed page fetch cannot leave them recorded but never announced
+        sent_files.update(obj["Key"] for obj in new_files)
+        last_key = listed_last_key
+
+        # Check for deleted files (only a full listing can tell us). Every
+        # listed key is in sent_files by now, so equal sizes mean nothing was
+        # deleted and the set difference can be skipped.
+        if full_scan and len(sent_files) > len(current_files):
+            deleted_files = sent_files - current_files
+        else:
+            deleted_files = set()
+
+        if new_files or deleted_files:
+            state_dirty = True
+
+        channel = bot.get_channel(DISCORD_CHANNEL_ID)
+        if new_files:
+            await announce_new_files(channel, new_files)
+        if deleted_files:
+            await remove_deleted_files(channel, deleted_files)
+        await flush_state()
+
+    except Exception as e:
+        print(f"[ERROR] Failed to monitor bucket: {e}")
+
+
+def parse_bucket_event(record):
+    """Turn an S3 event notification record into (sequencer, kind, object).
+
+    The object has the same Key/Size/LastModified fields as a listing entry.
+    """
+    obj = record["s3"]["object"]
+    event = {
+        # Keys in event notifications are URL-encoded
+        "Key": unquote_plus(obj["key"]),
+        "Size": obj.get("size", 0),
+        "LastModified": datetime.fromisoformat(
+            record["eventTime"].replace("Z", "+00:00")
+        ),
+    }
+    # The sequencer is a hex string that orders events for the same key
+    sequencer = int(obj.get("sequencer", "0"), 16)
+    return sequencer, record["eventName"].split(":", 1)[0], event
+
+
+def get_event_records(message):
+    """Extract the S3 event notification records from an SQS message."""
+    body = orjson.loads(message["Body"])
+    # Unwrap notifications delivered through SNS without raw delivery
+    if "Message" in body:
+        body = orjson.loads(body["Message"])
+
+    # Test events sent when notifications are configured have no Records
+    return body.get("Records", [])
+
+
+@tasks.loop(seconds=0)  # receive_message long-polls, so no delay is needed
+async def consume_events():
+    global state_dirty
     try:
-        response = s3.list_objects_v2(Bucket=S3_BUCKET_NAME)
-        contents = response.get("Contents", [])
-        current_files = {obj["Key"] for obj in contents}
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            aws_executor,
+            functools.partial(
+                sqs.receive_message,
+                QueueUrl=SQS_QUEUE_URL,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=20,
+            ),
+        )
+        messages = response.get("Messages", [])
+        if not messages:
+            return
+
+        # Parse the whole batch before touching sent_files, so a bad message
+        # cannot leave keys marked as sent without being announced. Malformed
+        # messages and records will never parse, so they are logged, skipped
+        # and acknowledged with the rest of the batch.
+        events = []
+        for message in messages:
+            try:
+                records = get_event_records(message)
+            except Exception as e:
+                print(
+                    f"[ERROR] Skipping malformed event message "
+                    f"{message.get('MessageId')}: {e}"
+                )
+                continue
+
+            for record in records:
+                try:
+                    if record["s3"]["bucket"]["name"] == S3_BUCKET_NAME:
+                        events.append(
+                            (*parse_bucket_event(record), message["ReceiptHandle"])
+                        )
+                except Exception as e:
+                    print(f"[ERROR] Skipping malformed bucket event: {e}")
+
+        # Events are not delivered in order, so apply only the latest event
+        # for each key (e.g. a delete followed by a re-upload leaves the file)
+        latest_events = {}
+        for event in sorted(events, key=lambda event: event[0]):
+            latest_events[event[2]["Key"]] = event
 
-        # Check for new files
         new_files = []
-        for obj in contents:
-            key = obj["Key"]
-            if key not in sent_files:
+        deleted_files = set()
+        applied_sequencers = {}
+        for key, (sequencer, kind, obj, receipt_handle) in latest_events.items():
+            # A standard queue can also deliver a key's events in different
+            # batches out of order, so skip anything not newer than the last
+            # event applied for that key
+            last_applied = event_sequencers.get(key)
+            if last_applied is not None and sequencer <= int(last_applied, 16):
+                continue
+            applied_sequencers[key] = sequencer
+
+            if kind == "ObjectCreated" and key not in sent_files:
                 sent_files.add(key)
                 new_files.append(obj)
+            elif kind == "ObjectRemoved" and key in sent_files:
+                deleted_files.add(key)
 
-        # Check for deleted files
-        deleted_files = sent_files - current_files
+        if new_files or deleted_files:
+            state_dirty = True
 
         channel = bot.get_channel(DISCORD_CHANNEL_ID)
-
-        # Handle new files
+        failed_files = set()
         if new_files:
-            for obj in new_files:
-                filename = obj["Key"]
-                size_mb, timestamp = get_file_metadata(obj)
-                download_url = build_download_url(filename)
-                message_id = await send_file_embed(
-                    channel, filename, size_mb, timestamp, download_url
-                )
-                file_messages[filename] = message_id
-
-        # Handle deleted files
+            failed_files = await announce_new_files(channel, new_files)
         if deleted_files:
-            for filename in deleted_files:
-                if filename in file_messages:
-                    try:
-                        message = await channel.fetch_message(file_messages[filename])
-                        await message.delete()
-                    except discord.NotFound:
-                        pass  # Message already deleted
-                    except Exception as e:
-                        print(f"[ERROR] Failed to delete message for {filename}: {e}")
-                    del file_messages[filename]
-                sent_files.discard(filename)
-
-        # Save changes if any occurred
-        if new_files or deleted_files:
-            save_sent_files(sent_files)
-            save_file_messages(file_messages)
+            await remove_deleted_files(channel, deleted_files)
+
+        # Files that failed to announce are retried on redelivery, so their
+        # events must not count as applied yet
+        for key, sequencer in applied_sequencers.items():
+            if key not in failed_files:
+                event_sequencers[key] = format(sequencer, "x")
+                state_dirty = True
+        await flush_state()
+
+        # Only acknowledge the messages once they have been handled. There is
+        # no full scan in this mode, so messages carrying a file whose embed
+        # failed are left on the queue for SQS to redeliver.
+        retry_handles = {latest_events[filename][3] for filename in failed_files}
+        entries = [
+            {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]}
+            for i, message in enumerate(messages)
+            if message["ReceiptHandle"] not in retry_handles
+        ]
+        if entries:
+            await loop.run_in_executor(
+                aws_executor,
+                functools.partial(
+                    sqs.delete_message_batch,
+                    QueueUrl=SQS_QUEUE_URL,
+                    Entries=entries,
+                ),
+            )
 
     except Exception as e:
-        print(f"[ERROR] Failed to monitor bucket: {e}")
+        print(f"[ERROR] Failed to consume bucket events: {e}")
+        await asyncio.sleep(SQS_RETRY_DELAY)
 
 
 @bot.event
 async def on_ready():
     print(f"[INFO] Logged in as {bot.user}!")
-    monitor_bucket.start()
+    if SQS_QUEUE_URL:
+        consume_events.start()
+    else:
+        monitor_bucket.start()
 
 
 if __name__ == "__main__":